@@ -12,14 +12,18 @@ __status__ = "Development"
 ###########################################################################
 
 import argparse
+import concurrent.futures
 import datetime
 from email import utils
+import errno
+import itertools
 import os
-import re
+import selectors
 import smtplib
 import socket
 import subprocess
 import sys
+import threading
 import time
 
 ###########################################################################
@@ -31,13 +35,22 @@ system. It the tries to restore each connection.
 
 Can optionally send mail and write to log file."""
 
+def _hostport(s):
+    """Parse ADDR:PORT into an (addr, port) tuple"""
+    
+    h, p = s.rsplit(':', 1)
+    p = int(p)
+    if not 0 < p < 65536:
+        raise ValueError("Port {} out of range".format(p))
+    return (h.strip('[]'), p)
+
 parser = argparse.ArgumentParser(description=description,
                                fromfile_prefix_chars='@', 
                                formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 parser.add_argument("--timeout", help="Timeout in seconds for each NET USE operation", type=int, default=60)
 parser.add_argument("--loops", help="Loop this many times od until all connections have been restored. 0 means loop forever", type=int, default=1)
 parser.add_argument("--loopdelay", help="Delay in seconds between loops", type=int, default=10)
-parser.add_argument("--conntest", help="Try connecting to ADDR:PORT as a test of general connectivity. The default is Google's public DNS server. Port 445 is SMB port", default='8.8.8.8:53', metavar="ADDR:PORT")
+parser.add_argument("--conntest", help="Try connecting to ADDR:PORT as a test of general connectivity. Several addresses are tried in parallel and the first to respond wins. The default is Google's public DNS server. Port 445 is SMB port", default=['8.8.8.8:53'], metavar="ADDR:PORT", nargs='+')
 parser.add_argument("--conntimeout", help="Timeout for connectivity test. Do not test if undefined", type=int)
 parser.add_argument("--logfile", help="Write messages to this log file. Do not write if undefined")
 parser.add_argument("--smtp", help="SMTP server for sending messages. Do not send messages if undefined")
@@ -52,68 +65,144 @@ args = parser.parse_args()
 ## Sanity checks
 if args.timeout < 1:
     raise ValueError("Option --timeout must be positive")
-if args.loops < 1:
-    raise ValueError("Option --loops must be positive")
+if args.loops < 0:
+    raise ValueError("Option --loops must be non-negative")
 if args.loopdelay < 1:
     raise ValueError("Option --loopdelay must be positive")
 if args.conntimeout and args.conntimeout < 0:
     raise ValueError("Option --conntimeout must be non-negative")
+try:
+    args.conntest = [_hostport(x) for x in args.conntest]
+except ValueError:
+    raise ValueError("Option --conntest must be ADDR:PORT")
 
 ###########################################################################
 # %%
 
-def conntest(addr_port, timeout):
-    """Test connection"""
+def backoff_iter(initial=0.1, cap=5.0, factor=2.0):
+    """Yield exponentially growing delays for retry loops, capped at cap"""
+    
+    delay = initial
+    while True:
+        yield delay
+        delay = min(delay*factor, cap)
+
+
+_IN_PROGRESS = (errno.EINPROGRESS, errno.EWOULDBLOCK, getattr(errno, 'WSAEWOULDBLOCK', errno.EWOULDBLOCK))
+
+def probe(addrinfos, timeout):
+    """Try non-blocking TCP connects to all addrinfos, succeeding on the first one to connect within timeout seconds"""
+    
+    deadline = time.monotonic() + timeout
+    socks = []
+    with selectors.DefaultSelector() as sel:
+        try:
+            for family, socktype, proto, _, sockaddr in addrinfos:
+                sock = socket.socket(family, socktype, proto)
+                socks.append(sock)
+                sock.setblocking(False)
+                err = sock.connect_ex(sockaddr)
+                if not err:
+                    return True
+                if err in _IN_PROGRESS:
+                    sel.register(sock, selectors.EVENT_WRITE)
+            while sel.get_map():
+                events = sel.select(max(deadline - time.monotonic(), 0))
+                if not events:
+                    return False
+                for key, _ in events:
+                    if not key.fileobj.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR):
+                        return True
+                    sel.unregister(key.fileobj)
+            return False
+        finally:
+            for sock in socks:
+                sock.close()
+
+
+def speculate(func, *args):
+    """Run func(*args) in a daemon thread, which does not hold up exit, and return a Future for the result"""
+    
+    future = concurrent.futures.Future()
+    def run():
+        try:
+            future.set_result(func(*args))
+        except Exception as e:
+            future.set_exception(e)
+    threading.Thread(target=run, daemon=True).start()
+    return future
+
+
+def conntest(addr_ports, timeout):
+    """Test connection to any of addr_ports"""
     
-    start = datetime.datetime.now()
+    deadline = time.monotonic() + timeout
+    delays = backoff_iter()
+    addrinfos = {}
+    lookups = {}
     while True:
+        ## Resolve candidates in parallel, probing those resolved so far
+        for addr_port in addr_ports:
+            if addr_port not in addrinfos and addr_port not in lookups:
+                lookups[addr_port] = speculate(socket.getaddrinfo, addr_port[0], addr_port[1], 0, socket.SOCK_STREAM)
+        if not addrinfos:
+            concurrent.futures.wait(list(lookups.values()), min(max(deadline - time.monotonic(), 0), 5),
+                                    concurrent.futures.FIRST_COMPLETED)
+        for addr_port, lookup in list(lookups.items()):
+            if lookup.done():
+                del lookups[addr_port]
+                if not lookup.exception():
+                    addrinfos[addr_port] = lookup.result()[0]
         try:
-            socket.create_connection((addr_port[0], int(addr_port[1])), 5)
-            return True
+            remaining = deadline - time.monotonic()
+            if addrinfos and probe(list(addrinfos.values()), min(remaining, 5)):
+                return True
         except Exception:
-            time.sleep(1)
-            if datetime.datetime.now() > start + datetime.timedelta(seconds=timeout):
-                return False
+            pass
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(min(next(delays), max(deadline - time.monotonic(), 0)))
+
 
+_log_lock = threading.Lock()
 
 def log(logfile, lines, loglines=None):
-    """Write to logfile and optionally append to an existing list of loglines"""
+    """Write lines to logfile and optionally append them to an existing list of loglines"""
     
-    if not logfile or not lines:
-        return
-    if type(lines) == str:
-        lines = [lines]
-    try:
-        with file(logfile, 'a') as f:
-            for line in lines:
-                f.write("{}\t{}\n".format(datetime.datetime.now(), line))
-            if loglines:
-                loglines.append(line)
-    except Exception:
-        pass
-    if loglines:
+    if not lines:
         return loglines
+    if loglines is not None:
+        loglines.extend(lines)
+    if logfile:
+        ts = datetime.datetime.now().isoformat(sep=' ', timespec='microseconds')
+        payload = "".join("{}\t{}\n".format(ts, line) for line in lines).encode('utf-8')
+        with _log_lock:
+            try:
+                fd = os.open(logfile, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+                try:
+                    os.write(fd, payload)
+                finally:
+                    os.close(fd)
+            except Exception:
+                pass
+    return loglines
 
 
 def send(logfile, smtp, sender, recipients, lines):
-    """Send lines via email"""
+    """Send a sequence of lines via email"""
     
     if not smtp or not sender or not recipients or not lines:
         return
-    if type(lines) == str:
-        lines = [lines]
+    body = "\n".join(lines)
+    if not body:
+        return
     try:
-        mess = ["Date: {}".format(utils.formatdate(time.mktime(time.localtime()), True)),
-                "From: {}".format(sender),
-                "To: {}".format(", ".join(recipients)),
-                "Subject: NET restore report",
-                "",
-                "\n".join(lines)]
-        s = smtplib.SMTP(smtp)
-        s.sendmail(sender, recipients, "\n".join(mess))
-        s.quit()
+        mess = "Date: {}\nFrom: {}\nTo: {}\nSubject: NET restore report\n\n{}".format(
+            utils.formatdate(time.time(), localtime=True), sender, ", ".join(recipients), body)
+        with smtplib.SMTP(smtp) as s:
+            s.sendmail(sender, recipients, mess)
     except Exception:
-        log(logfile, "SMTP server {} unreachable/unusable".format(smtp))
+        log(logfile, ("SMTP server {} unreachable/unusable".format(smtp),))
    
 
 def log_and_send(logfile, smtp, sender, recipients, lines):
@@ -122,56 +211,88 @@ def log_and_send(logfile, smtp, sender, recipients, lines):
     log(logfile, lines)
     send(logfile, smtp, sender, recipients, lines)
 
+_NO_WINDOW = getattr(subprocess, 'CREATE_NO_WINDOW', 0)
+_NET_ENCODING = 'oem' if os.name == 'nt' else None
+
 def list_connections(timeout, dumpnetuse=False):
     """Call NET USE to determine the state of connections"""
     
+    deadline = time.monotonic() + timeout
+    delays = backoff_iter()
     while True:
-        start = datetime.datetime.now()
         try:
-            net_use = subprocess.check_output("net use".split())
+            with subprocess.Popen(["net", "use"], stdout=subprocess.PIPE, encoding=_NET_ENCODING, errors='replace',
+                                  shell=False, creationflags=_NO_WINDOW) as p:
+                try:
+                    connections = parse_connections(p.stdout, dumpnetuse)
+                except Exception:
+                    p.kill()
+                    raise
+            if p.returncode:
+                raise subprocess.CalledProcessError(p.returncode, "net use")
             errors = False
             break
         except Exception:
             errors = True
-            if datetime.datetime.now() > start + datetime.timedelta(seconds=timeout):
+            if time.monotonic() > deadline:
                 break
             else:
-                time.sleep(1)
-    return (errors, None if errors else parse_connections(net_use, dumpnetuse))
+                time.sleep(min(next(delays), max(deadline - time.monotonic(), 0)))
+    return (errors, None if errors else connections)
     
 
-def parse_connections(line, dumpnetuse=False):
-    """Parse the output of NET USE"""
+def is_drive(col):
+    """Check if col looks like a drive letter, e.g., 'S:'"""
     
-    lines = line.splitlines()
-    if dumpnetuse:
-        log(args.logfile, str(lines))
+    return len(col) >= 2 and col[1] == ':' and 'A' <= col[0] <= 'Z'
+
+
+_STATUS_OK = frozenset(('OK',))
+_NETWORK = 'Microsoft Windows Network'
+_NETWORK_COLS = _NETWORK.split()
+
+def parse_connections(stream, dumpnetuse=False):
+    """Parse the output of NET USE, line by line"""
     
+    dump = []
     connections = []
-    for line, next in zip(lines[:-1], lines[1:]):
-        cols = line.split()
-        nextcols = next.split()
-        if len(cols) == 6 and re.match("[A-Z]:", cols[1]) and cols[3:] == ['Microsoft', 'Windows', 'Network'] or\
-            len(cols) == 3 and len(nextcols) == 3 and re.match("[A-Z]:", cols[1]) and nextcols == ['Microsoft', 'Windows', 'Network']:
-            connections.append((cols[0] == 'OK', cols[1], cols[2]))
+    prev = None
+    for line in stream:
+        if dumpnetuse:
+            dump.append(line.rstrip('\r\n'))
+        line = line.rstrip()
+        if line.endswith(_NETWORK):
+            if line.lstrip() == _NETWORK:
+                cols, network = (prev or '').split(), []
+            else:
+                cols, network = line.split(), _NETWORK_COLS
+            if len(cols) >= 3:
+                status, drive, unc, *tail = cols
+                if tail == network and is_drive(drive):
+                    connections.append((status in _STATUS_OK, drive, unc))
+        prev = line
+    if dumpnetuse:
+        log(args.logfile, (str(dump),))
     return connections
 
 
 def connect(connection, timeout):
     """Tries to reconnect a connection"""
     
-    start = datetime.datetime.now()
+    cmd = ["net", "use", connection[1], connection[2]]
+    deadline = time.monotonic() + timeout
+    delays = backoff_iter()
     while True:
         try:
-            subprocess.check_output("net use {} {}".format(connection[1], connection[2]).split(), stderr=subprocess.STDOUT)
+            subprocess.check_output(cmd, stderr=subprocess.STDOUT, shell=False, creationflags=_NO_WINDOW)
             errors = False
             break
         except Exception as e:
             errors = True
-            if datetime.datetime.now() > start + datetime.timedelta(seconds=timeout):
+            if time.monotonic() > deadline:
                 break
             else:
-                time.sleep(1)
+                time.sleep(min(next(delays), max(deadline - time.monotonic(), 0)))
     return not errors
 
 ###########################################################################
@@ -181,44 +302,64 @@ def connect(connection, timeout):
 if args.testmail:
     if not args.smtp or not args.recipients:
         raise ValueError("Missing option(s) --smtp and/or --recipient")
-    log_and_send(args.logfile, args.smtp, args.sender, args.recipients, "This is a test message")
+    log_and_send(args.logfile, args.smtp, args.sender, args.recipients, ("This is a test message",))
     sys.exit(0)
 
-## Perhaps test connectivity
-if args.conntimeout and not conntest(args.conntest.split(':'), args.conntimeout):
-    log_and_send(args.logfile, args.smtp, args.sender, args.recipients, "{} not reachable after {}s".format(args.conntest, args.conntimeout))
-    sys.exit(1)
+## Perhaps test connectivity, listing connections in the meantime
+listing = None
+if args.conntimeout:
+    listing = speculate(list_connections, args.timeout, args.dumpnetuse)
+    if not conntest(args.conntest, args.conntimeout):
+        log_and_send(args.logfile, args.smtp, args.sender, args.recipients, ("{} not reachable after {}s".format(", ".join("{}:{}".format(*x) for x in args.conntest), args.conntimeout),))
+        sys.exit(1)
 
 ## Loop until connections have been restored
 loglines = []
-for loop in range(args.loops):
+for loop in (range(args.loops) if args.loops else itertools.count()):
 
     ## Log loop
-    loglines = log(args.logfile, "Loop {} of {}".format(loop+1, args.loops if not args.loops == sys.maxint else 'inf'), loglines)
+    loglines = log(args.logfile, ("Loop {} of {}".format(loop+1, args.loops if args.loops else 'inf'),), loglines)
     if loop:
-        loglines = log(args.logfile, "Delay {}s".format(args.loopdelay), loglines)
+        loglines = log(args.logfile, ("Delay {}s".format(args.loopdelay),), loglines)
         time.sleep(args.loopdelay)
     
     ## Get a list of connections and we're done if they are all connected
-    (errors, connections) = list_connections(args.timeout, args.dumpnetuse)
+    (errors, connections) = listing.result() if listing else list_connections(args.timeout, args.dumpnetuse)
+    listing = None
     if errors:
-        log_and_send(args.logfile, args.smtp, args.sender, args.recipients, "Could not read connection list")
+        log_and_send(args.logfile, args.smtp, args.sender, args.recipients, ("Could not read connection list",))
         sys.exit(1)
+    connections = [list(x) for x in connections]
     
     ## Get a list of connected connections
     ok = [x[1]+x[2] for x in connections if x[0]]
     if len(ok):
-        loglines = log(args.logfile, "Existing {}".format(", ".join(ok)), loglines)
+        loglines = log(args.logfile, ("Existing {}".format(", ".join(ok)),), loglines)
         if len(ok) == len(connections):
             break
-    for idx, connection in enumerate(connections):
-        reportline = "{}{}".format(connection[1], connection[2])
+
+    ## Restore disconnected connections, concurrently unless debugging
+    pending = [x for idx, x in enumerate(connections) if not x[0] and (not args.onebyone or not idx)]
+    restored = {}
+    if args.onebyone:
+        for connection in pending:
+            restored[connection[1]] = connect(connection, args.timeout)
+    elif pending:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(pending), 16)) as executor:
+            futures = dict((executor.submit(connect, x, args.timeout), x) for x in pending)
+            for future in concurrent.futures.as_completed(futures):
+                restored[futures[future][1]] = future.result()
+    for connection in connections:
         if not connection[0]:
-            if (args.onebyone and not idx or not args.onebyone) and connect(connection, args.timeout):
+            reportline = "{}{}".format(connection[1], connection[2])
+            if restored.get(connection[1]):
+                connection[0] = True
                 logline = "Restored {}".format(reportline)
             else:
                 logline = "Problems {}".format(reportline)
-        loglines = log(args.logfile, logline, loglines)
+            loglines = log(args.logfile, (logline,), loglines)
+    if all(x[0] for x in connections):
+        break
 
 ## Done
 send(args.logfile, args.smtp, args.sender, args.recipients, loglines)